@@ -1,33 +1,60 @@
 # app.py
 
 import streamlit as st
-import xml.etree.ElementTree as ET
+from lxml import etree as ET # Also a hard dependency of python-docx
 import pandas as pd
+import xlsxwriter
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import io
 import re
+import functools
+import collections
 
 # --- Helper Functions ---
 
+# One datasource column; original_name is kept for matching against worksheet references
+Column = collections.namedtuple('Column', 'name original_name role datatype type is_calculated formula')
+
+# Shelf keys -> friendly names (rows, cols, marks card which includes filters there too)
+_SHELF_TYPES = {
+    'rows': 'Rows',
+    'cols': 'Columns',
+    'color': 'Marks - Color',
+    'size': 'Marks - Size',
+    'label': 'Marks - Label',
+    'detail': 'Marks - Detail',
+    'tooltip': 'Marks - Tooltip',
+    'shape': 'Marks - Shape',
+    'angle': 'Marks - Angle',
+    'filter': 'Filters Shelf' # Filters can also appear on marks card shelves
+}
+_SHELF_RE = re.compile('(' + '|'.join(map(re.escape, _SHELF_TYPES)) + ')') # Matched against lowercased shelf-item names
+
+@functools.lru_cache(maxsize=8192) # Same field names recur across every filter/shelf
 def clean_field_name(name):
     """Cleans Tableau's internal field name for display."""
-    match = re.match(r"\[(.*?)\]\.\[(.*?)\]", name)
-    if match:
-        return match.group(2)
+    # [Datasource].[Field] -> Field, split with str.partition instead of a regex.
+    # The datasource part may itself contain ']' (Tableau escapes it as ']]'), so split at the first '].['
+    if name[:1] == '[':
+        datasource, sep, rest = name.partition('].[')
+        if sep:
+            field, close, _ = rest.partition(']')
+            if close and '\n' not in datasource and '\n' not in field: # Like regex '.', never span a newline
+                return field
     return name.replace("[", "").replace("]", "")
 
 def get_datasource_details(root):
-    """Parses all datasources and their columns."""
+    """Parses all datasources (including root itself) and their columns."""
     datasources_data = {}
-    for ds_node in root.findall('.//datasource'):
+    for ds_node in root.iter('datasource'):
         ds_name = ds_node.get('name') or ds_node.get('caption')
         if not ds_name: # Fallback for 'federated' datasources without explicit name/caption
             ds_name = ds_node.get('formatted-name', 'Unknown Datasource')
 
         columns = []
-        for col_node in ds_node.findall('.//column'):
+        for col_node in ds_node.iter('column'):
             col_name = col_node.get('name') or col_node.get('caption')
             col_role = col_node.get('role')
             col_datatype = col_node.get('datatype')
@@ -36,15 +63,8 @@ def get_datasource_details(root):
             calculation_node = col_node.find('calculation')
             formula = calculation_node.get('formula') if calculation_node is not None else None
             
-            columns.append({
-                'name': clean_field_name(col_name),
-                'original_name': col_name, # Keep original for matching
-                'role': col_role,
-                'datatype': col_datatype,
-                'type': col_type,
-                'is_calculated': bool(formula),
-                'formula': formula
-            })
+            columns.append(Column(clean_field_name(col_name), col_name, col_role, col_datatype,
+                                  col_type, bool(formula), formula))
         datasources_data[ds_name] = columns
     return datasources_data
 
@@ -53,7 +73,7 @@ def get_worksheet_details(ws_node, all_datasources_info):
     ws_name = ws_node.get('name')
     details = {
         'name': ws_name,
-        'datasources_used': set(),
+        'datasources_used': {}, # Used as an ordered set (keys only)
         'dimensions': [],
         'measures': [],
         'calculated_fields_used': [],
@@ -63,210 +83,360 @@ def get_worksheet_details(ws_node, all_datasources_info):
 
     # Identify datasources used by this worksheet
     ws_datasources = {} # name -> alias or name
-    for ds_dep_node in ws_node.findall('.//datasource-dependencies'):
+    for ds_dep_node in ws_node.iter('datasource-dependencies'): # Needed before any field lookups
         ds_name = ds_dep_node.get('datasource')
         if ds_name:
-            details['datasources_used'].add(ds_name)
+            details['datasources_used'][ds_name] = None
             # Find the actual columns for this datasource
             if ds_name in all_datasources_info:
                  ws_datasources[ds_name] = all_datasources_info[ds_name]
             elif ds_dep_node.get('caption') and ds_dep_node.get('caption') in all_datasources_info: # try caption
                 ds_name_from_caption = ds_dep_node.get('caption')
-                details['datasources_used'].add(ds_name_from_caption)
+                details['datasources_used'][ds_name_from_caption] = None
                 ws_datasources[ds_name_from_caption] = all_datasources_info[ds_name_from_caption]
 
 
+    # Index the worksheet's columns by original and cleaned name (first datasource wins)
+    field_index = {}
+    for ds_cols in ws_datasources.values():
+        for col_data in ds_cols:
+            field_index.setdefault(col_data.original_name, col_data)
+            field_index.setdefault(col_data.name, col_data)
+
     # Helper to find field details from worksheet's datasources
     def find_field_in_ws_datasources(field_name_to_find):
-        cleaned_field_name_to_find = clean_field_name(field_name_to_find)
-        for ds_cols in ws_datasources.values():
-            for col_data in ds_cols:
-                if col_data['name'] == cleaned_field_name_to_find or col_data['original_name'] == field_name_to_find:
-                    return col_data
-        return None # Not found in this worksheet's specific datasources
-
-    # Parse filters
-    for filter_node in ws_node.findall('.//filter'):
+        # None if not found in this worksheet's specific datasources
+        return field_index.get(field_name_to_find) or field_index.get(clean_field_name(field_name_to_find))
+
+    def handle_filter(filter_node, parent_node):
         field_name = filter_node.get('column')
         if field_name:
             field_detail = find_field_in_ws_datasources(field_name)
             filter_info = {
                 'field': clean_field_name(field_name),
                 'class': filter_node.get('class'), # e.g., 'categorical', 'quantitative'
-                'datatype': field_detail.get('datatype') if field_detail else 'N/A'
+                'datatype': field_detail.datatype if field_detail else 'N/A'
             }
             # Try to get members for categorical filters (simplified)
             members = []
-            for member_node in filter_node.findall('.//member'):
+            for member_node in filter_node.iter('member'):
                 members.append(member_node.get('value'))
             if members:
                 filter_info['members'] = members
+            filter_info['members_str'] = ', '.join(members) # Joined once for every output format
             details['filters'].append(filter_info)
-    
-    # Parse shelves (rows, cols, marks card which includes filters there too)
-    shelf_types = {
-        'rows': 'Rows',
-        'cols': 'Columns',
-        'color': 'Marks - Color',
-        'size': 'Marks - Size',
-        'label': 'Marks - Label',
-        'detail': 'Marks - Detail',
-        'tooltip': 'Marks - Tooltip',
-        'shape': 'Marks - Shape',
-        'angle': 'Marks - Angle',
-        'filter': 'Filters Shelf' # Filters can also appear on marks card shelves
-    }
 
-    for column_instance_node in ws_node.findall('.//view/.//column-instance'): # More general way to find fields on shelves
+    # Field names already listed, per output list
+    seen_names = {'dimensions': set(), 'measures': set(), 'calculated_fields_used': set()}
+
+    def handle_column_instance(column_instance_node, parent_shelf): # More general way to find fields on shelves
         field_name = column_instance_node.get('column')
         shelf_type_raw = column_instance_node.get('type') # e.g. 'quantitative', 'nominal', 'ordinal'
         # The actual shelf is usually found in parent 'shelf-item' or ancestor 'pane'
         # This is a simplification, getting precise shelf can be tricky.
         # For now, we'll just list fields found in the view section.
         
-        parent_shelf = column_instance_node.getparent()
         shelf_name = "Unknown Shelf"
         if parent_shelf is not None and parent_shelf.tag == 'shelf-item':
             shelf_name = parent_shelf.get('name', "Unknown Shelf Item") # e.g. [MarkShelf].[ColorShelf]
             # Try to map to a friendlier name
-            for key, friendly_name in shelf_types.items():
-                if key in shelf_name.lower():
-                    shelf_name = friendly_name
-                    break
+            shelf_match = _SHELF_RE.search(shelf_name.lower())
+            if shelf_match:
+                shelf_name = _SHELF_TYPES[shelf_match.group(1)]
         elif parent_shelf is not None: # could be 'rows', 'cols' directly under 'pane'
             shelf_name = parent_shelf.tag # 'rows' or 'cols'
-            if shelf_name in shelf_types:
-                shelf_name = shelf_types[shelf_name]
+            if shelf_name in _SHELF_TYPES:
+                shelf_name = _SHELF_TYPES[shelf_name]
 
 
         if field_name:
             field_detail = find_field_in_ws_datasources(field_name)
             if field_detail:
                 shelf_entry = {
-                    'field': field_detail['name'],
-                    'role': field_detail['role'],
-                    'datatype': field_detail['datatype'],
+                    'field': field_detail.name,
+                    'role': field_detail.role,
+                    'datatype': field_detail.datatype,
                     'shelf': shelf_name,
                     'type_on_shelf': shelf_type_raw # how it's used (e.g. discrete/continuous)
                 }
                 details['fields_on_shelves'].append(shelf_entry)
 
-                if field_detail['is_calculated']:
-                    # Avoid duplicates if already listed globally
-                    if not any(cf['name'] == field_detail['name'] for cf in details['calculated_fields_used']):
-                        details['calculated_fields_used'].append(field_detail)
-                elif field_detail['role'] == 'dimension':
-                    if not any(d['name'] == field_detail['name'] for d in details['dimensions']):
-                         details['dimensions'].append(field_detail)
-                elif field_detail['role'] == 'measure':
-                    if not any(m['name'] == field_detail['name'] for m in details['measures']):
-                        details['measures'].append(field_detail)
+                if field_detail.is_calculated:
+                    field_list = 'calculated_fields_used'
+                elif field_detail.role == 'dimension':
+                    field_list = 'dimensions'
+                elif field_detail.role == 'measure':
+                    field_list = 'measures'
+                else:
+                    return
+                # Avoid duplicates (important if a field is on multiple shelves)
+                if field_detail.name not in seen_names[field_list]:
+                    seen_names[field_list].add(field_detail.name)
+                    details[field_list].append(field_detail)
+
+    # Filters and shelf fields in one walk of the worksheet, dispatched by tag.
+    # The walk carries each node's parent so shelf detection doesn't need getparent().
+    handlers = {
+        'filter': handle_filter,
+        'column-instance': handle_column_instance,
+    }
+    stack = [(ws_node, None)]
+    while stack:
+        node, parent_node = stack.pop()
+        if node.tag in handlers:
+            handlers[node.tag](node, parent_node)
+        stack.extend((child, node) for child in reversed(node)) # Reversed so nodes pop in document order
+
+    # Freeze in document order so every render/download lists datasources the same way
+    details['datasources_used'] = tuple(details['datasources_used'])
+    details['datasources_used_str'] = ", ".join(details['datasources_used'])
     
-    # Deduplicate (important if a field is on multiple shelves)
-    details['dimensions'] = [dict(t) for t in {tuple(d.items()) for d in details['dimensions']}]
-    details['measures'] = [dict(t) for t in {tuple(d.items()) for d in details['measures']}]
-    details['calculated_fields_used'] = [dict(t) for t in {tuple(d.items()) for d in details['calculated_fields_used']}]
+    return details
 
+def get_dashboard_details(db_node, all_worksheet_nodes, all_datasources_info):
+    """Parses a single dashboard: its worksheets and other zone objects."""
+    db_name = db_node.get('name')
+    dashboard_info = {
+        'name': db_name,
+        'worksheets': [],
+        'objects': [] # For other dashboard objects like text, images (names only)
+    }
 
-    return details
+    # Find worksheets within this dashboard
+    # Worksheets are typically inside zones
+    for zone_node in db_node.iter('zone'):
+        worksheet_name_in_zone = zone_node.get('name') # This is the name of the worksheet
+        if worksheet_name_in_zone and zone_node.get('type') == 'worksheet':
+            if worksheet_name_in_zone in all_worksheet_nodes:
+                ws_node = all_worksheet_nodes[worksheet_name_in_zone]
+                ws_details = get_worksheet_details(ws_node, all_datasources_info)
+                dashboard_info['worksheets'].append(ws_details)
+            else:
+                st.warning(f"Worksheet '{worksheet_name_in_zone}' referenced in dashboard '{db_name}' not found in workbook.")
+        
+        # Capture other object names (text, images, web pages, etc.)
+        obj_name = zone_node.get('name')
+        obj_type = zone_node.get('type')
+        param_name = zone_node.get('param') # For parameters/filters displayed directly
+        
+        if obj_type and obj_type != 'worksheet':
+            name_to_add = obj_name
+            if obj_type == 'layout-basic': # Often containers
+                continue # Skip generic containers unless they have specific content
+            if not name_to_add and param_name: # e.g. <zone ... type='filter' param='[Parameters].[Parameter 1]' ... />
+                name_to_add = clean_field_name(param_name)
+            
+            if name_to_add:
+                 dashboard_info['objects'].append({'name': name_to_add, 'type': obj_type})
+
+    return dashboard_info
+
+def release_element(elem):
+    """Frees a fully processed element and any earlier siblings during iterparse."""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+class _ReferencedWorksheetCollector:
+    """lxml parser target that records worksheet names placed in dashboard zones, without building a tree."""
+    def __init__(self):
+        self.names = set()
 
+    def start(self, tag, attrib):
+        if tag == 'zone' and attrib.get('type') == 'worksheet':
+            self.names.add(attrib.get('name'))
+
+    def close(self):
+        return self.names
+
+def get_referenced_worksheets(xml_content):
+    """Returns the names of worksheets used by at least one dashboard."""
+    parser = ET.XMLParser(target=_ReferencedWorksheetCollector(), huge_tree=True)
+    return ET.fromstring(xml_content, parser)
+
+# Keyed on the uploaded bytes, so reruns (e.g. download clicks) skip re-parsing. The cache is shared by every
+# session, so only the last few workbooks are kept (and for an hour at most); evicted ones are just re-parsed.
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
 def parse_twb(xml_content):
-    """Main parsing function."""
-    root = ET.fromstring(xml_content)
+    """Main parsing function. Streams the TWB so large workbooks aren't held as one big DOM."""
     workbook_docs = []
-
-    all_datasources_info = get_datasource_details(root)
-    
-    # Create a lookup for all worksheet nodes by name
-    all_worksheet_nodes = {ws.get('name'): ws for ws in root.findall('.//worksheet')}
-
-    for db_node in root.findall('.//dashboard'):
-        db_name = db_node.get('name')
-        dashboard_info = {
-            'name': db_name,
-            'worksheets': [],
-            'objects': [] # For other dashboard objects like text, images (names only)
-        }
-
-        # Find worksheets within this dashboard
-        # Worksheets are typically inside zones
-        for zone_node in db_node.findall('.//zone'):
-            worksheet_name_in_zone = zone_node.get('name') # This is the name of the worksheet
-            if worksheet_name_in_zone and zone_node.get('type') == 'worksheet':
-                if worksheet_name_in_zone in all_worksheet_nodes:
-                    ws_node = all_worksheet_nodes[worksheet_name_in_zone]
-                    ws_details = get_worksheet_details(ws_node, all_datasources_info)
-                    dashboard_info['worksheets'].append(ws_details)
-                else:
-                    st.warning(f"Worksheet '{worksheet_name_in_zone}' referenced in dashboard '{db_name}' not found in workbook.")
-            
-            # Capture other object names (text, images, web pages, etc.)
-            obj_name = zone_node.get('name')
-            obj_type = zone_node.get('type')
-            param_name = zone_node.get('param') # For parameters/filters displayed directly
-            
-            if obj_type and obj_type != 'worksheet':
-                name_to_add = obj_name
-                if obj_type == 'layout-basic': # Often containers
-                    continue # Skip generic containers unless they have specific content
-                if not name_to_add and param_name: # e.g. <zone ... type='filter' param='[Parameters].[Parameter 1]' ... />
-                    name_to_add = clean_field_name(param_name)
-                
-                if name_to_add:
-                     dashboard_info['objects'].append({'name': name_to_add, 'type': obj_type})
-
-
-        workbook_docs.append(dashboard_info)
+    all_datasources_info = {}
+    all_worksheet_nodes = {} # Worksheet nodes by name, kept until the dashboards are processed
+    referenced_worksheets = get_referenced_worksheets(xml_content) # Hidden/orphan sheets are never documented
+    open_sheets = 0 # Worksheets/dashboards currently open; datasources inside them are just references
+
+    # TWB order is datasources -> worksheets -> dashboards, so by the time a
+    # dashboard ends every datasource and worksheet it references has been seen.
+    context = ET.iterparse(io.BytesIO(xml_content), events=("start", "end"),
+                           tag=("datasource", "worksheet", "dashboard"), huge_tree=True)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag != 'datasource':
+                open_sheets += 1
+            continue
+
+        if elem.tag == 'datasource':
+            for ds_name, columns in get_datasource_details(elem).items():
+                # Worksheets carry bare <datasource> references; don't let those wipe the real column list
+                if ds_name not in all_datasources_info or columns:
+                    all_datasources_info[ds_name] = columns
+            if not open_sheets:
+                release_element(elem) # Columns are indexed, the XML is dead weight now
+        elif elem.tag == 'worksheet':
+            open_sheets -= 1
+            if elem.get('name') in referenced_worksheets:
+                all_worksheet_nodes[elem.get('name')] = elem # Needed later, so not cleared
+            else:
+                elem.clear() # Siblings may still be needed, so only this subtree goes
+        elif elem.tag == 'dashboard':
+            open_sheets -= 1
+            workbook_docs.append(get_dashboard_details(elem, all_worksheet_nodes, all_datasources_info))
+            release_element(elem)
     
     return workbook_docs, all_datasources_info
 
 
 # --- Output Generation ---
 
-def generate_excel(docs_data):
-    """Generates an Excel file from the parsed data."""
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        for i, dashboard in enumerate(docs_data):
-            df_data = []
-            # Sheet name limit is 31 chars, make unique if dashboards have similar long names
-            sheet_name = re.sub(r'[\[\]\*:\\\?\/]', '', dashboard['name'])[:25] + f"_{i}"
-
-
-            df_data.append({'Section': 'Dashboard Info', 'Item': 'Name', 'Details': dashboard['name']})
-            if dashboard['objects']:
-                 df_data.append({'Section': 'Dashboard Info', 'Item': 'Other Objects', 
-                                 'Details': ", ".join([f"{obj['name']} ({obj['type']})" for obj in dashboard['objects']])})
-
-
-            for ws in dashboard['worksheets']:
-                ws_header = f"Worksheet: {ws['name']}"
-                df_data.append({'Section': ws_header, 'Item': 'Datasources', 'Details': ", ".join(list(ws['datasources_used']))})
-
-                for dim in ws['dimensions']:
-                    df_data.append({'Section': ws_header, 'Item': 'Dimension', 'Details': f"{dim['name']} (Type: {dim['datatype']})"})
-                for meas in ws['measures']:
-                    df_data.append({'Section': ws_header, 'Item': 'Measure', 'Details': f"{meas['name']} (Type: {meas['datatype']})"})
-                for cf in ws['calculated_fields_used']:
-                    df_data.append({'Section': ws_header, 'Item': 'Calculated Field', 'Details': f"{cf['name']} (Formula: {cf['formula']})"})
-                for filt in ws['filters']:
-                    members_str = f" (Members: {', '.join(filt.get('members', []))})" if filt.get('members') else ""
-                    df_data.append({'Section': ws_header, 'Item': 'Filter', 'Details': f"{filt['field']} (Type: {filt.get('class', 'N/A')}){members_str}"})
-                for shelf_item in ws['fields_on_shelves']:
-                     df_data.append({'Section': ws_header, 'Item': f"Field on Shelf ({shelf_item['shelf']})", 
-                                     'Details': f"{shelf_item['field']} (Role: {shelf_item['role']}, Datatype: {shelf_item['datatype']}, Usage: {shelf_item['type_on_shelf']})"})
-            
-            df = pd.DataFrame(df_data)
-            if not df.empty:
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-    return output.getvalue()
+# Characters Excel doesn't allow in sheet names
+_SHEET_TRANS = str.maketrans('', '', '[]*:\\?/')
+
+# Per-worksheet field lists, in the order every output renders them
+FIELD_GROUPS = ('dimensions', 'measures', 'calculated_fields_used', 'filters', 'fields_on_shelves')
+
+# One worksheet field in a common shape, whatever list it came from; built once and shared by every sink
+FieldRecord = collections.namedtuple('FieldRecord', 'group name datatype formula filter_class members shelf role usage',
+                                     defaults=(None, None, None, '', None, None, None))
+
+# How one output words field details (see describe_field)
+FieldWording = collections.namedtuple('FieldWording', 'name_format datatype_label members_label shelf_details')
+
+_SHELF_DETAIL_LABELS = {'shelf': 'On', 'role': 'Role', 'datatype': 'Datatype', 'usage': 'Usage'}
+
+def field_record(group, entry):
+    """Converts an entry of a worksheet field list into a FieldRecord."""
+    if group == 'filters':
+        return FieldRecord(group, entry['field'], entry['datatype'], filter_class=entry.get('class', 'N/A'),
+                           members=entry['members_str'])
+    if group == 'fields_on_shelves':
+        return FieldRecord(group, entry['field'], entry['datatype'], shelf=entry['shelf'], role=entry['role'],
+                           usage=entry['type_on_shelf'])
+    return FieldRecord(group, entry.name, entry.datatype, entry.formula, role=entry.role) # Column
+
+def describe_field(record, wording):
+    """Formats a field record's details text in one output's wording."""
+    name = wording.name_format.format(record.name)
+    if record.group == 'calculated_fields_used':
+        return f"{name} (Formula: {record.formula})"
+    if record.group == 'filters':
+        members_str = f" ({wording.members_label}: {record.members})" if record.members else ""
+        return f"{name} (Type: {record.filter_class}){members_str}"
+    if record.group == 'fields_on_shelves':
+        details = ", ".join(f"{_SHELF_DETAIL_LABELS[key]}: {getattr(record, key)}" for key in wording.shelf_details)
+        return f"{name} ({details})"
+    return f"{name} ({wording.datatype_label}: {record.datatype})"
+
+def render_all(docs_data, *sinks):
+    """Walks the parsed dashboards once, emitting each piece to every sink."""
+    for i, dashboard in enumerate(docs_data):
+        for sink in sinks:
+            sink.dashboard_header(i, dashboard)
+        for ws in dashboard['worksheets']:
+            for sink in sinks:
+                sink.worksheet_header(ws)
+            for group in FIELD_GROUPS:
+                if ws[group]: # Empty sections are skipped by every output
+                    records = [field_record(group, entry) for entry in ws[group]]
+                    for sink in sinks:
+                        sink.fields(group, records)
+            for sink in sinks:
+                sink.worksheet_footer(ws)
+        for sink in sinks:
+            sink.dashboard_footer(dashboard)
+
+class DocumentSink:
+    """Receives render_all events; subclasses override the ones their output needs."""
+    def dashboard_header(self, index, dashboard):
+        pass
+
+    def worksheet_header(self, ws):
+        pass
+
+    def fields(self, group, records):
+        pass
+
+    def worksheet_footer(self, ws):
+        pass
+
+    def dashboard_footer(self, dashboard):
+        pass
+
+class ExcelSink(DocumentSink):
+    """Writes one sheet per dashboard as (Section, Item, Details) rows."""
+    WORDING = FieldWording('{}', 'Type', 'Members', ('role', 'datatype', 'usage'))
+    ITEM_LABELS = {
+        'dimensions': 'Dimension',
+        'measures': 'Measure',
+        'calculated_fields_used': 'Calculated Field',
+        'filters': 'Filter',
+    }
 
-def generate_word(docs_data):
-    """Generates a Word document from the parsed data."""
-    doc = Document()
-    doc.add_heading('Tableau Workbook Documentation', level=0)
+    def __init__(self):
+        self.output = io.BytesIO()
+        # constant_memory flushes each row as it's written, so RAM stays flat for big workbooks
+        self.workbook = xlsxwriter.Workbook(self.output, {'constant_memory': True, 'strings_to_urls': False})
+        self.header_format = self.workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
 
-    for dashboard in docs_data:
+    def add_row(self, section, item, details):
+        self.sheet.write_row(self.row, 0, (section, item, details))
+        self.row += 1
+
+    def dashboard_header(self, index, dashboard):
+        # Sheet name limit is 31 chars, make unique if dashboards have similar long names
+        sheet_name = dashboard['name'].translate(_SHEET_TRANS)[:25] + f"_{index}"
+        self.sheet = self.workbook.add_worksheet(sheet_name)
+        self.sheet.write_row(0, 0, ('Section', 'Item', 'Details'), self.header_format)
+        self.row = 1
+
+        self.add_row('Dashboard Info', 'Name', dashboard['name'])
+        if dashboard['objects']:
+             self.add_row('Dashboard Info', 'Other Objects', 
+                          ", ".join([f"{obj['name']} ({obj['type']})" for obj in dashboard['objects']]))
+
+    def worksheet_header(self, ws):
+        self.section = f"Worksheet: {ws['name']}"
+        self.add_row(self.section, 'Datasources', ws['datasources_used_str'])
+
+    def fields(self, group, records):
+        for record in records:
+            item = self.ITEM_LABELS.get(group) or f"Field on Shelf ({record.shelf})"
+            self.add_row(self.section, item, describe_field(record, self.WORDING))
+
+    def close(self):
+        self.workbook.close()
+        return self.output.getvalue()
+
+class WordSink(DocumentSink):
+    """Builds the Word documentation, including the component list for snippet numbering."""
+    FIELD_HEADINGS = {
+        'dimensions': "Dimensions Used:",
+        'measures': "Measures Used:",
+        'calculated_fields_used': "Calculated Fields Used:",
+        'filters': "Filters:",
+        'fields_on_shelves': "Fields on Shelves:",
+    }
+    WORDING = FieldWording('{}', 'Datatype', 'Selected', ('shelf', 'role', 'usage'))
+
+    def __init__(self):
+        self.doc = Document()
+        self.doc.add_heading('Tableau Workbook Documentation', level=0)
+        # Resolve list styles once; passing a name makes python-docx look it up on every paragraph
+        self.list_bullet_style = self.doc.styles['List Bullet']
+        self.list_number_style = self.doc.styles['List Number']
+        self.skip_worksheet = False
+
+    def dashboard_header(self, index, dashboard):
+        doc = self.doc
         doc.add_heading(f"Dashboard: {dashboard['name']}", level=1)
         
         # Placeholder for snippet instructions
@@ -282,11 +452,11 @@ def generate_word(docs_data):
         if dashboard['objects']:
             doc.add_paragraph(f"  General Objects:")
             for obj in dashboard['objects']:
-                 doc.add_paragraph(f"    {num}. {obj['name']} ({obj['type']})", style='ListNumber')
+                 doc.add_paragraph(f"    {num}. {obj['name']} ({obj['type']})", style=self.list_number_style)
                  num +=1
 
         for i_ws, ws in enumerate(dashboard['worksheets']):
-            doc.add_paragraph(f"  {num}. Worksheet: {ws['name']}", style='ListNumber')
+            doc.add_paragraph(f"  {num}. Worksheet: {ws['name']}", style=self.list_number_style)
             num +=1
         doc.add_paragraph("--- End of Component List ---")
 
@@ -294,47 +464,122 @@ def generate_word(docs_data):
         if dashboard['objects']:
             doc.add_heading("Dashboard-Level Objects", level=2)
             for obj in dashboard['objects']:
-                doc.add_paragraph(f"- {obj['name']} (Type: {obj['type']})", style='ListBullet')
+                doc.add_paragraph(f"- {obj['name']} (Type: {obj['type']})", style=self.list_bullet_style)
+
+    def worksheet_header(self, ws):
+        # Nothing to document: leave the worksheet to the component list rather than an empty section
+        self.skip_worksheet = not ws['datasources_used'] and not any(ws[group] for group in FIELD_GROUPS)
+        if self.skip_worksheet:
+            return
+        self.doc.add_heading(f"Worksheet: {ws['name']}", level=2)
+        
+        if ws['datasources_used']:
+            self.doc.add_paragraph(f"Datasources: {ws['datasources_used_str']}")
+
+    def fields(self, group, records):
+        doc = self.doc
+        doc.add_heading(self.FIELD_HEADINGS[group], level=3)
+        for record in records:
+            if group == 'calculated_fields_used':
+                # Formulas can be long, so they get their own indented paragraph under the name
+                doc.add_paragraph(f"{record.name}", style=self.list_bullet_style)
+                p_formula = doc.add_paragraph(f"  Formula: {record.formula}")
+                p_formula.paragraph_format.left_indent = Inches(0.5)
+            else:
+                doc.add_paragraph(f"- {describe_field(record, self.WORDING)}", style=self.list_bullet_style)
+
+    def worksheet_footer(self, ws):
+        if not self.skip_worksheet:
+            self.doc.add_paragraph() # Add some space
+
+    def close(self):
+        output = io.BytesIO()
+        self.doc.save(output)
+        return output.getvalue()
+
+class StreamlitSink(DocumentSink):
+    """Renders the documentation on the page, one expander per worksheet."""
+    FIELD_HEADINGS = {
+        'dimensions': "**Dimensions Used:**",
+        'measures': "**Measures Used:**",
+        'calculated_fields_used': "**Calculated Fields Used:**",
+        'filters': "**Filters:**",
+        'fields_on_shelves': "**Fields on Shelves (Rows, Columns, Marks, etc.):**",
+    }
+    WORDING = FieldWording('`{}`', 'Type', 'Selected', ()) # Shelves render as a table instead
+
+    def dashboard_header(self, index, dashboard_data):
+        st.subheader(f"Dashboard {index+1}: {dashboard_data['name']}")
+
+        # Placeholder for Snippet Section
+        st.markdown(f"**Visual Snippet Area (Manual)**")
+        st.info(f"""
+        Please take a screenshot of the '{dashboard_data['name']}' dashboard.
+        The downloadable Word document will provide a list of components (see below)
+        that you can use to number sections on your screenshot.
+        """)
+        
+        # List components for numbering
+        st.markdown("**Dashboard Components (for numbering):**")
+        comp_num = 1
+        if dashboard_data['objects']:
+            st.markdown("  *General Objects:*")
+            for obj in dashboard_data['objects']:
+                st.markdown(f"    {comp_num}. {obj['name']} ({obj['type']})")
+                comp_num +=1
+        
+        for ws_idx, ws_data in enumerate(dashboard_data['worksheets']):
+            st.markdown(f"  {comp_num}. *Worksheet:* {ws_data['name']}")
+            comp_num += 1
+
+
+        # Dashboard-level objects
+        if dashboard_data['objects']:
+            with st.expander(f"Dashboard-Level Objects/Controls ({len(dashboard_data['objects'])} items)"):
+                for obj in dashboard_data['objects']:
+                    st.write(f"- **{obj['name']}** (Type: {obj['type']})")
+
+    def worksheet_header(self, ws_data):
+        # Worksheets in Dashboard; later events write into this expander
+        self.ws_expander = st.expander(f"Worksheet: {ws_data['name']}")
+        self.ws_expander.markdown(f"**Datasources:** {ws_data['datasources_used_str'] or 'N/A'}")
+
+    def fields(self, group, records):
+        box = self.ws_expander
+        box.markdown(self.FIELD_HEADINGS[group])
+        if group == 'calculated_fields_used':
+            for record in records:
+                box.markdown(f"- `{record.name}`")
+                box.code(f"Formula: {record.formula}", language='sql') # or 'plaintext'
+        elif group == 'fields_on_shelves':
+            # Create a small dataframe for better display
+            shelf_df_data = []
+            for record in records:
+                shelf_df_data.append({
+                    'Field': record.name, 
+                    'Shelf': record.shelf, 
+                    'Role': record.role, 
+                    'Datatype': record.datatype,
+                    'Usage (Type on Shelf)': record.usage
+                })
+            box.dataframe(pd.DataFrame(shelf_df_data))
+        else:
+            for record in records:
+                box.markdown(f"- {describe_field(record, self.WORDING)}")
 
-        for ws in dashboard['worksheets']:
-            doc.add_heading(f"Worksheet: {ws['name']}", level=2)
-            
-            if ws['datasources_used']:
-                doc.add_paragraph(f"Datasources: {', '.join(list(ws['datasources_used']))}")
+    def dashboard_footer(self, dashboard_data):
+        st.markdown("---")
 
-            if ws['dimensions']:
-                doc.add_heading("Dimensions Used:", level=3)
-                for item in ws['dimensions']:
-                    doc.add_paragraph(f"- {item['name']} (Datatype: {item['datatype']})", style='ListBullet')
-            
-            if ws['measures']:
-                doc.add_heading("Measures Used:", level=3)
-                for item in ws['measures']:
-                    doc.add_paragraph(f"- {item['name']} (Datatype: {item['datatype']})", style='ListBullet')
-
-            if ws['calculated_fields_used']:
-                doc.add_heading("Calculated Fields Used:", level=3)
-                for item in ws['calculated_fields_used']:
-                    doc.add_paragraph(f"{item['name']}", style='ListBullet')
-                    p_formula = doc.add_paragraph(f"  Formula: {item['formula']}")
-                    p_formula.paragraph_format.left_indent = Inches(0.5)
-            
-            if ws['filters']:
-                doc.add_heading("Filters:", level=3)
-                for item in ws['filters']:
-                    members_str = f" (Selected: {', '.join(item.get('members', []))})" if item.get('members') else ""
-                    doc.add_paragraph(f"- {item['field']} (Type: {item.get('class', 'N/A')}){members_str}", style='ListBullet')
-
-            if ws['fields_on_shelves']:
-                doc.add_heading("Fields on Shelves:", level=3)
-                for item in ws['fields_on_shelves']:
-                     doc.add_paragraph(f"- {item['field']} (On: {item['shelf']}, Role: {item['role']}, Usage: {item['type_on_shelf']})", style='ListBullet')
-            
-            doc.add_paragraph() # Add some space
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600) # Same bound as parse_twb: a few workbooks, evicted ones get rebuilt
+def generate_documents(xml_content, _docs_data):
+    """Builds the Excel and Word files in one pass over the parsed data. Returns (excel_bytes, word_bytes).
 
-    output = io.BytesIO()
-    doc.save(output)
-    return output.getvalue()
+    The cache is keyed on the file bytes (cheap to hash); the leading underscore keeps
+    st.cache_data from deep-hashing the parsed tree on every call.
+    """
+    excel_sink, word_sink = ExcelSink(), WordSink()
+    render_all(_docs_data, excel_sink, word_sink)
+    return excel_sink.close(), word_sink.close()
 
 
 # --- Streamlit App UI ---
@@ -372,91 +617,22 @@ if uploaded_file is not None:
                 for ds_name, ds_cols in all_datasources_info.items():
                     with st.expander(f"Datasource: {ds_name} ({len(ds_cols)} columns)"):
                         # Display only a few columns initially or provide a table
-                        df_cols = pd.DataFrame(ds_cols)
+                        df_cols = pd.DataFrame(ds_cols, columns=Column._fields)
                         st.dataframe(df_cols[['name', 'role', 'datatype', 'is_calculated', 'formula']].head(10), height=300)
                         if len(df_cols) > 10:
                             st.caption(f"...and {len(df_cols)-10} more columns.")
 
 
             # Display Dashboard by Dashboard
-            for i, dashboard_data in enumerate(parsed_docs):
-                st.subheader(f"Dashboard {i+1}: {dashboard_data['name']}")
-
-                # Placeholder for Snippet Section
-                st.markdown(f"**Visual Snippet Area (Manual)**")
-                st.info(f"""
-                Please take a screenshot of the '{dashboard_data['name']}' dashboard.
-                The downloadable Word document will provide a list of components (see below)
-                that you can use to number sections on your screenshot.
-                """)
-                
-                # List components for numbering
-                st.markdown("**Dashboard Components (for numbering):**")
-                comp_num = 1
-                if dashboard_data['objects']:
-                    st.markdown("  *General Objects:*")
-                    for obj in dashboard_data['objects']:
-                        st.markdown(f"    {comp_num}. {obj['name']} ({obj['type']})")
-                        comp_num +=1
-                
-                for ws_idx, ws_data in enumerate(dashboard_data['worksheets']):
-                    st.markdown(f"  {comp_num}. *Worksheet:* {ws_data['name']}")
-                    comp_num += 1
-
-
-                # Dashboard-level objects
-                if dashboard_data['objects']:
-                    with st.expander(f"Dashboard-Level Objects/Controls ({len(dashboard_data['objects'])} items)"):
-                        for obj in dashboard_data['objects']:
-                            st.write(f"- **{obj['name']}** (Type: {obj['type']})")
-                
-                # Worksheets in Dashboard
-                for ws_idx, ws_data in enumerate(dashboard_data['worksheets']):
-                    with st.expander(f"Worksheet: {ws_data['name']}"):
-                        st.markdown(f"**Datasources:** {', '.join(list(ws_data['datasources_used'])) if ws_data['datasources_used'] else 'N/A'}")
-
-                        if ws_data['dimensions']:
-                            st.markdown("**Dimensions Used:**")
-                            for item in ws_data['dimensions']: st.markdown(f"- `{item['name']}` (Type: {item['datatype']})")
-                        
-                        if ws_data['measures']:
-                            st.markdown("**Measures Used:**")
-                            for item in ws_data['measures']: st.markdown(f"- `{item['name']}` (Type: {item['datatype']})")
-
-                        if ws_data['calculated_fields_used']:
-                            st.markdown("**Calculated Fields Used:**")
-                            for item in ws_data['calculated_fields_used']:
-                                st.markdown(f"- `{item['name']}`")
-                                st.code(f"Formula: {item['formula']}", language='sql') # or 'plaintext'
-                        
-                        if ws_data['filters']:
-                            st.markdown("**Filters:**")
-                            for item in ws_data['filters']:
-                                members_str = f" (Selected: {', '.join(item.get('members', []))})" if item.get('members') else ""
-                                st.markdown(f"- `{item['field']}` (Type: {item.get('class', 'N/A')}){members_str}")
-                        
-                        if ws_data['fields_on_shelves']:
-                            st.markdown("**Fields on Shelves (Rows, Columns, Marks, etc.):**")
-                            # Create a small dataframe for better display
-                            shelf_df_data = []
-                            for item in ws_data['fields_on_shelves']:
-                                shelf_df_data.append({
-                                    'Field': item['field'], 
-                                    'Shelf': item['shelf'], 
-                                    'Role': item['role'], 
-                                    'Datatype': item['datatype'],
-                                    'Usage (Type on Shelf)': item['type_on_shelf']
-                                })
-                            if shelf_df_data:
-                                st.dataframe(pd.DataFrame(shelf_df_data))
-                st.markdown("---")
-
-            # Download Buttons
+            render_all(parsed_docs, StreamlitSink())
+
+            # Download Buttons; built here (not in a deferred callable) so failures reach the error display below.
+            # Both files come from one cached pass, so reruns and clicks don't rebuild them.
             st.header("Download Documentation")
+            excel_data, word_data = generate_documents(xml_content, parsed_docs)
             col1, col2 = st.columns(2)
             
             with col1:
-                excel_data = generate_excel(parsed_docs)
                 st.download_button(
                     label="📥 Download as Excel",
                     data=excel_data,
@@ -464,7 +640,6 @@ if uploaded_file is not None:
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
             with col2:
-                word_data = generate_word(parsed_docs)
                 st.download_button(
                     label="📄 Download as Word",
                     data=word_data,